@@ -1,13 +1,24 @@
 import asyncio
-import json
-import subprocess
-import sched, time
-import threading
+import logging
+import os
+import shutil
+import time
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 from slixmpp import JID
 
 from xmpp_message_bot import MessageIn, MessageOut, EchoBot
 
+log = logging.getLogger(__name__)
+
+_PRODUCT_TMPL = "Item: {pid}\nCurrent stock: {stock}\nStore: {store}\nRestock Date: {restock}\nForecast:\n"
+_FORECAST_TMPL = "-----\n\tProbability: {p}\n\tDate: {d}\n\tStock: {s}\n"
+_PRODUCT_SEPARATOR = "\n---------\n\n"
+
 
 class Bot:
     def __init__(self, coordinator, name=""):
@@ -19,46 +30,100 @@ class Bot:
 
 
 class IkeaBot(Bot):
-    def __init__(self, coordinator, delay, name=""):
+    def __init__(self, coordinator, delay, store, items, subscribers, name=""):
         super().__init__(coordinator, name)
-        self.command = ["npx", "ikea-availability-checker", "stock", "--store=560", "--reporter", "json", "40431564",
-                        "90341151"]
+        if not items:
+            raise ValueError("IkeaBot needs at least one item to check")
+        if not subscribers:
+            raise ValueError("IkeaBot needs at least one subscriber to notify")
+        # Running an installed checker directly skips npx resolving the package on every run
+        checker = shutil.which("ikea-availability-checker")
+        launcher = (checker,) if checker else ("npx", "ikea-availability-checker")
+        # All items go into one checker run
+        self.command = (*launcher, "stock", f"--store={store}", "--reporter", "json", *items)
         self.delay = delay
-        self.subscribers = [JID("JID_SUB1"), JID("JID_SUB2")]
-        self.coordinator.scheduler.enter(self.delay, 1, self.checkAvailability)
+        self.subscribers = tuple(JID(subscriber) for subscriber in subscribers)
+        self._cache = None
+        self._cache_ts = 0.0
+        self._cache_ttl = 30
+        self._cache_lock = asyncio.Lock()
+        self._command_timeout = 30
+        # Created on the main thread, which is the one that goes on to run the loop in Coordinator.start
+        self.coordinator.xmpp.create_task(self._schedule())
 
     def processMessage(self, msg: MessageIn):
-        response = ""
-        if msg.body == "status":
-            products = self.executeCommand()
+        # Messages are dispatched from the XMPP loop itself, so don't block it waiting for the checker
+        self.coordinator.xmpp.create_task(self._processMessage(msg))
+
+    async def _processMessage(self, msg: MessageIn):
+        parts = []
+        if msg.body.lower() == "status":
+            try:
+                products = await self.executeCommand()
+            except Exception:
+                log.exception("Could not check availability")
+                products = []
+                parts.append("Could not check availability right now, try again later.")
             for product in products:
-                response = response + "Item: " + product["productId"] + "\n"
-                response = response + "Current stock: " + str(product["availability"]["stock"]) + "\n"
-                response = response + "Store: " + product["store"]["name"] + "\n"
-                response = response + "Restock Date: " + product["availability"]["restockDate"][:10] + "\n"
-
-                forecasts = product["availability"]["forecast"]
-                response = response + "Forecast:\n"
-            for forecast in forecasts:
-                response = response + "-----\n"
-                response = response + "\tProbability: " + forecast["probability"] + "\n"
-                response = response + "\tDate: " + forecast["date"][:10] + "\n"
-                response = response + "\tStock: " + str(forecast["stock"]) + "\n"
-            response = response + "\n---------\n\n"
+                availability = product["availability"]
+                parts.append(_PRODUCT_TMPL.format(pid=product["productId"], stock=availability["stock"],
+                                                  store=product["store"]["name"],
+                                                  restock=availability["restockDate"][:10]))
+
+                forecasts = availability.get("forecast", [])
+                parts.extend([_FORECAST_TMPL.format(p=f["probability"], d=f["date"][:10], s=f["stock"])
+                              for f in forecasts])
+                parts.append(_PRODUCT_SEPARATOR)
+        response = "".join(parts)
+        if not response:
+            return None
 
         msg_out = MessageOut(mto=msg.mfrom, mtype=msg.mtype, body=response)
         self.coordinator.sendMessage(msg_out)
 
-    def executeCommand(self):
-        # result = subprocess.run(["cat", "stock.json"], capture_output=True, text=True)
-        result = subprocess.run(self.command, capture_output=True, text=True)
-        result = "[\n" + result.stdout[2:-3] + "]"
-        products = json.loads(result)
-
-        return products
-
-    def checkAvailability(self):
-        products = self.executeCommand()
+    async def executeCommand(self):
+        # Status requests and the periodic poll share one result for a short while
+        async with self._cache_lock:
+            if self._cache is not None and time.monotonic() - self._cache_ts < self._cache_ttl:
+                return self._cache
+
+            # proc = await asyncio.create_subprocess_exec("cat", "stock.json", stdout=asyncio.subprocess.PIPE)
+            proc = await asyncio.create_subprocess_exec(*self.command, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), self._command_timeout)
+            except asyncio.TimeoutError:
+                # Don't let a hung checker hold the cache lock, and with it every later request
+                proc.kill()
+                await proc.wait()
+                raise RuntimeError("Availability checker did not finish within %s seconds" % self._command_timeout)
+            # Failed runs raise before the cache is touched, so they are neither cached nor read as "no stock"
+            if proc.returncode != 0:
+                raise RuntimeError("Availability checker exited with %d: %s"
+                                   % (proc.returncode, stderr.decode(errors="replace").strip()))
+            if not stdout.strip():
+                raise RuntimeError("Availability checker returned no output")
+            # Both orjson and json take bytes directly, so skip decoding stdout to str first
+            raw = bytearray(b"[\n")
+            raw += memoryview(stdout)[2:-3]
+            raw += b"]"
+            products = _json.loads(raw)
+
+            self._cache = products
+            self._cache_ts = time.monotonic()
+            return products
+
+    async def _schedule(self):
+        while True:
+            await asyncio.sleep(self.delay)
+            try:
+                await self.checkAvailability()
+            except Exception:
+                # Keep polling, the next run may well succeed
+                log.exception("Availability check failed")
+
+    async def checkAvailability(self):
+        products = await self.executeCommand()
 
         for product in products:
             item = product["productId"]
@@ -66,53 +131,54 @@ class IkeaBot(Bot):
             if stock != 0:
                 body = "Friheten is available! Item: " + str(item) + ", stock: " + str(stock) + ". Try ordering " \
                                                                                                 "online or call +1-414-766-0560. Extension 1412."
-                for subscriber in self.subscribers:
-                    self.coordinator.sendMessage(MessageOut(subscriber, "chat", body))
+                self.coordinator.sendBroadcast(self.subscribers, "chat", body)
 
-        self.coordinator.scheduler.enter(self.delay, 1, self.checkAvailability)
         return None
 
 
+def _env_list(name, default):
+    value = os.environ.get(name, default)
+    return [entry.strip() for entry in value.split(",") if entry.strip()]
+
+
 class Coordinator:
     def __init__(self, jid, password):
-        self.bots = []
+        self.bots = {}
         self.xmpp = EchoBot(jid, password)
         self.xmpp.initialize()
         self.xmpp.setMessageReceivedCallback(self.processMessage)
 
-        self.scheduler = sched.scheduler(time.time, time.sleep)
-
     def start(self):
-        th = threading.Thread(target=self.wrapper)
-        th.start()
+        # EchoBot already made its loop the current one; process() is deprecated in newer slixmpp
         self.xmpp.connect()
-        self.xmpp.process()
-        self.xmpp.loop.stop()
-        th.join()
-
-    def wrapper(self):
-        self.scheduler.run(blocking=True)
+        self.xmpp.loop.run_forever()
 
     def addBot(self, bot: Bot):
-        self.bots.append(bot)
+        self.bots[bot.name] = bot
 
     def processMessage(self, msg: MessageIn):
-        msg.body = msg.body.lower()
-        parts = msg.body.split(" ")
-        for bot in self.bots:
-            if parts[0] == bot.name:
-                msg.body = msg.body[len(parts[0]) + 1:]
-                bot.processMessage(msg)
+        name, _, rest = msg.body.partition(" ")
+        bot = self.bots.get(name.lower())
+        if bot is not None:
+            msg.body = rest
+            bot.processMessage(msg)
 
     def sendMessage(self, msg: MessageOut):
         self.xmpp.send_message(msg)
 
+    def sendBroadcast(self, recipients, mtype: str, body):
+        self.xmpp.send_broadcast(recipients, mtype, body)
+
 
 if __name__ == '__main__':
     jid = "JID_BOT"
     password = "YOUR_PASSWORD"
 
+    store = os.environ.get("IKEA_STORE", "560")
+    items = _env_list("IKEA_ITEMS", "40431564,90341151")
+    subscribers = _env_list("IKEA_SUBSCRIBERS", "JID_SUB1,JID_SUB2")
+
     coord = Coordinator(jid, password)
-    ikeabot = IkeaBot(coord, 60, "ikea")
+    ikeabot = IkeaBot(coord, 60, store, items, subscribers, "ikea")
     coord.addBot(ikeabot)
     coord.start()
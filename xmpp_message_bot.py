@@ -11,10 +11,10 @@
 """
 import os
 import re
+import copy
 import sys
 import asyncio
 import logging
-import threading
 
 from slixmpp import ClientXMPP, JID
 from slixmpp.exceptions import IqTimeout, IqError
@@ -24,14 +24,24 @@ from slixmpp_omemo import PluginCouldNotLoad, MissingOwnKey, EncryptionPrepareEx
 from slixmpp_omemo import UndecidedException, UntrustedException, NoAvailableSession
 from omemo.exceptions import MissingBundleException
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 log = logging.getLogger(__name__)
 
 # Used by the EchoBot
 LEVEL_DEBUG = 0
 LEVEL_ERROR = 1
 
+# How many times encryption is retried after the OMEMO plugin gave up on a recipient's devices
+MAX_ENCRYPT_RETRIES = 3
+
 
 class MessageIn:
+    __slots__ = ("mfrom", "mtype", "body", "error")
+
     def __init__(self, mfrom: JID = None, mtype: str = "", body=""):
         self.mfrom = mfrom
         self.mtype = mtype
@@ -39,11 +49,12 @@ class MessageIn:
         self.error = False
 
     def __str__(self):
-        return "mfrom: " + str(self.mfrom) + ", mtype: " + self.mtype + ", body: " + str(self.body) + ", error: " + str(
-            self.error)
+        return f"mfrom: {self.mfrom}, mtype: {self.mtype}, body: {self.body}, error: {self.error}"
 
 
 class MessageOut:
+    __slots__ = ("mto", "mtype", "body", "error")
+
     def __init__(self, mto: JID = None, mtype: str = "", body=""):
         self.mto = mto
         self.mtype = mtype
@@ -51,13 +62,13 @@ class MessageOut:
         self.error = False
 
     def __str__(self):
-        return "mto: " + str(self.mto) + ", mtype: " + self.mtype + ", body: " + str(self.body) + ", error: " + str(
-            self.error)
+        return f"mto: {self.mto}, mtype: {self.mtype}, body: {self.body}, error: {self.error}"
 
 
-def start_background_loop(loop: asyncio.AbstractEventLoop) -> None:
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
 
 
 class EchoBot(ClientXMPP):
@@ -73,11 +84,14 @@ class EchoBot(ClientXMPP):
     debug_level: int = LEVEL_DEBUG  # or LEVEL_ERROR
 
     def __init__(self, jid, password):
-        self.loop = asyncio.new_event_loop()
-        t = threading.Thread(target=start_background_loop, args=(self.loop,), daemon=True)
-        t.start()
+        # slixmpp resets its loop in __init__ and then takes whatever asyncio.get_event_loop()
+        # returns, so make ours the current one first and everything runs on the same loop
+        loop = new_event_loop()
+        asyncio.set_event_loop(loop)
 
         ClientXMPP.__init__(self, jid, password)
+        self.loop = loop
+        self._tasks = set()
         self.onMessageReceived = None
         self.add_event_handler("session_start", self.start)
         self.add_event_handler("message", self.receive_message)
@@ -132,7 +146,7 @@ class EchoBot(ClientXMPP):
         except (MissingOwnKey,) as exn:
             # The message is missing our own key, it was not encrypted for
             # us, and we can't decrypt it.
-            log.error('Decryption Error. Message not encrypted for me: ' + str(exn))
+            log.error('Decryption Error. Message not encrypted for me: %s', exn)
         except (NoAvailableSession,) as exn:
             # We received a message from that contained a session that we
             # don't know about (deleted session storage, etc.). We can't
@@ -141,7 +155,7 @@ class EchoBot(ClientXMPP):
             # best if we send an encrypted message directly. XXX: Is it
             # where we talk about self-healing messages?
             log.error('Decryption Error. Message uses an encrypted '
-                      'session I don\'t know about:'  + str(exn))
+                      'session I don\'t know about: %s', exn)
         except (UndecidedException, UntrustedException) as exn:
             # We received a message from an untrusted device. We can
             # choose to decrypt the message nonetheless, with the
@@ -151,33 +165,114 @@ class EchoBot(ClientXMPP):
             # or not. Clients _should_ indicate that the message was not
             # trusted, or in undecided state, if they decide to decrypt it
             # anyway.
-            log.warning("Decryption Error. Your device is not in my trusted devices:" + str(exn))
+            log.warning("Decryption Error. Your device is not in my trusted devices: %s", exn)
             await self._decrypt_message(msg, True)
         except (EncryptionPrepareException,) as exn:
             # Slixmpp tried its best, but there were errors it couldn't
             # resolve. At this point you should have seen other exceptions
             # and given a chance to resolve them already.
-            log.error("Decryption Error. I was not able to decrypt the message:" + str(exn))
+            log.error("Decryption Error. I was not able to decrypt the message: %s", exn)
         except (Exception,) as exn:
-            log.error("Decryption Error. Exception occured while attempting decryption." + str(exn))
+            log.error("Decryption Error. Exception occured while attempting decryption. %s", exn)
+
+    def create_task(self, coro) -> asyncio.Task:
+        """
+        Schedule a coroutine on the bot's loop. Must be called from the loop's
+        thread. A reference to the task is kept until it finishes, and any
+        exception it raises is logged instead of being dropped.
+        """
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Task %r failed", task, exc_info=task.exception())
 
     def receive_message(self, msg: Message):
-        asyncio.run_coroutine_threadsafe(self._decrypt_message(msg), self.loop)
-        # asyncio.ensure_future(self._decrypt_message(msg))
+        self.create_task(self._decrypt_message(msg))
 
     def send_message(self, msg: MessageOut):
-        asyncio.run_coroutine_threadsafe(self._send_encrypted_message(JID(msg.mto), msg.mtype, msg.body), self.loop)
-        # asyncio.ensure_future(
-        #    self._send_encrypted_message(JID(msg.mto), msg.mtype, msg.body))
+        mto = msg.mto if isinstance(msg.mto, JID) else JID(msg.mto)
+        self.create_task(self._send_encrypted_message(mto, msg.mtype, msg.body))
+
+    def send_broadcast(self, recipients, mtype: str, body):
+        recipients = [recipient if isinstance(recipient, JID) else JID(recipient) for recipient in recipients]
+        self.create_task(self._send_encrypted_broadcast(recipients, mtype, body))
 
     async def _send_encrypted_message(self, mto: JID, mtype: str, body):
         """Helper to reply with encrypted messages"""
 
-        msg = self.make_message(mto=mto, mtype=mtype)
-        msg['eme']['namespace'] = self.eme_ns
-        msg['eme']['name'] = self['xep_0380'].mechanisms[self.eme_ns]
+        return await self._send_encrypted_broadcast([mto], mtype, body)
+
+    async def _send_encrypted_broadcast(self, recipients, mtype: str, body):
+        """
+        Encrypt the body once for every recipient and send each of
+        them a message carrying that same encrypted payload. If that
+        fails, fall back to encrypting for each recipient separately,
+        so one bad recipient doesn't cost everybody the message.
+        """
+
+        if not body or not recipients:
+            # Nothing to say, don't pay for an OMEMO encryption round
+            return None
+
+        if len(recipients) == 1:
+            encrypt = await self._encrypt(recipients, body)
+            if encrypt is not None:
+                self._send_encrypted(recipients, mtype, encrypt)
+            return None
+
+        try:
+            encrypt = await self._encrypt(recipients, body)
+        except Exception:
+            log.exception("An error occurred while attempting to encrypt for %s", self._names(recipients))
+            encrypt = None
+        if encrypt is not None:
+            self._send_encrypted(recipients, mtype, encrypt)
+            return None
+
+        # Nothing has been sent yet, so nobody gets the message twice
+        log.warning("Could not encrypt for all of %s at once, sending to each separately", self._names(recipients))
+        for mto in recipients:
+            try:
+                encrypt = await self._encrypt([mto], body)
+            except Exception:
+                # Carry on with the others
+                log.exception("An error occurred while attempting to encrypt for %s", mto)
+                continue
+            if encrypt is not None:
+                self._send_encrypted([mto], mtype, encrypt)
+        return None
+
+    @staticmethod
+    def _names(recipients) -> str:
+        return ", ".join(str(mto) for mto in recipients)
+
+    def _send_encrypted(self, recipients, mtype: str, encrypt) -> None:
+        # Build the stanza once and only readdress copies of it
+        template = self.make_message(mto=recipients[0], mtype=mtype)
+        template['eme']['namespace'] = self.eme_ns
+        template['eme']['name'] = self._eme_name
+        template.append(encrypt)
+        for mto in recipients:
+            msg = copy.copy(template)
+            msg['to'] = mto
+            if self.use_message_ids:
+                msg['id'] = self.new_id()
+            msg.send()
+
+    async def _encrypt(self, recipients, body):
+        """
+        Encrypt the body for all recipients in one go. Returns the
+        `<encrypted/>` payload, or None if encryption had to be given up.
+        """
 
         expect_problems = {}  # type: Optional[Dict[JID, List[int]]]
+        trusted = set()
+        retries = 0
 
         while True:
             try:
@@ -191,16 +286,17 @@ class EchoBot(ClientXMPP):
                 # allows you to encrypt for 1:1 as well as groupchats (MUC).
                 #
                 # `expect_problems`: See EncryptionPrepareException handling.
-                recipients = [mto]
-                encrypt = await self['xep_0384'].encrypt_message(body, recipients, expect_problems)
-                msg.append(encrypt)
-                return msg.send()
+                return await self['xep_0384'].encrypt_message(body, recipients, expect_problems)
             except UndecidedException as exn:
                 # The library prevents us from sending a message to an
                 # untrusted/undecided barejid, so we need to make a decision here.
                 # This is where you prompt your user to ask what to do. In
                 # this bot we will automatically trust undecided recipients.
-                log.warning("Adding new trusted device: " + str(exn))
+                if (exn.bare_jid, exn.device) in trusted:
+                    log.error("Device is still undecided after trusting it, giving up: %s", exn)
+                    return None
+                trusted.add((exn.bare_jid, exn.device))
+                log.warning("Adding new trusted device: %s", exn)
                 self['xep_0384'].trust(exn.bare_jid, exn.device, exn.ik)
             # TODO: catch NoEligibleDevicesException
             except EncryptionPrepareException as exn:
@@ -208,7 +304,11 @@ class EchoBot(ClientXMPP):
                 # all it could and doesn't know what to do anymore. It
                 # contains a list of exceptions that the user must resolve, or
                 # explicitely ignore via `expect_problems`.
-                # TODO: We might need to bail out here if errors are the same?
+                #
+                # `encrypt_message` only raises this once its own fix-up loop
+                # saw the same errors twice, so retrying only helps if we now
+                # expect a problem we didn't expect before.
+                new_problems = False
                 for error in exn.errors:
                     if isinstance(error, MissingBundleException):
                         # We choose to ignore MissingBundleException. It seems
@@ -218,18 +318,24 @@ class EchoBot(ClientXMPP):
                         # device won't be able to decrypt and should display a
                         # generic message. The receiving end-user at this
                         # point can bring up the issue if it happens.
-                        log.warning('Could not find keys for device  of recipient . Skipping.' + str(error))
                         jid = JID(error.bare_jid)
                         device_list = expect_problems.setdefault(jid, [])
-                        device_list.append(error.device)
+                        if error.device not in device_list:
+                            log.warning('Could not find keys for device %s of recipient %s. Skipping. %s',
+                                        error.device, error.bare_jid, error)
+                            device_list.append(error.device)
+                            new_problems = True
+                if not new_problems:
+                    log.error("Giving up on encryption, no new devices to skip: %r", exn.errors)
+                    return None
+                # Backstop in case devices keep turning up
+                retries += 1
+                if retries > MAX_ENCRYPT_RETRIES:
+                    log.error("Giving up on encryption after %d retries: %r", MAX_ENCRYPT_RETRIES, exn.errors)
+                    return None
             except (IqError, IqTimeout) as exn:
-                log.error('An error occurred while fetching information on a recipient.\n%r' % exn)
+                log.error('An error occurred while fetching information on a recipient.\n%r', exn)
                 return None
-            except Exception as exn:
-                log.error('An error occurred while attempting to encrypt.\n%r' % exn)
-                raise
-
-        return None
 
     def setMessageReceivedCallback(self, callback):
         self.onMessageReceived = callback
@@ -242,7 +348,7 @@ class EchoBot(ClientXMPP):
         )
 
         # Setup logging.
-        logging.basicConfig(level=logging.INFO,
+        logging.basicConfig(level=logging.WARNING,
                             format='%(levelname)-8s %(message)s',
                             filename='xmppBot.log', filemode='w')
 
@@ -251,6 +357,7 @@ class EchoBot(ClientXMPP):
         self.register_plugin('xep_0030')  # Service Discovery
         self.register_plugin('xep_0199')  # XMPP Ping
         self.register_plugin('xep_0380')  # Explicit Message Encryption
+        self._eme_name = self['xep_0380'].mechanisms[self.eme_ns]
 
         try:
             self.register_plugin(